@@ -1,11 +1,54 @@
 #!/usr/bin/env python3
 
+import argparse
+import hashlib
+import json
+import mmap
 import os
+import re
 import shutil
 import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache
 
 MAX_EQ_STEPS = 5
 POSRES_SCHEDULE = [(400, 40), (300, 30), (200, 20), (100, 10), (50, 5)]
+DEFINE_RE = re.compile(r"^[ \t]*define\b.*$", re.M)
+DEFINE_RE_BYTES = re.compile(DEFINE_RE.pattern.encode(), re.M)
+DEFINE_TMPL = "define                  = -DPOSRES -DPOSRES_FC_BB={bb} -DPOSRES_FC_SC={sc}\n"
+
+# Output intervals injected into generated equilibration mdps when absent
+EQ_OUTPUT_INTERVALS = {"nstxout-compressed": 50000, "nstenergy": 5000}
+
+# Older names grompp still accepts for the same parameter (never both at once)
+MDP_KEY_ALIASES = {
+    "nstxout-compressed": ["nstxtcout"],
+    "compressed-x-precision": ["xtc-precision"],
+    "compressed-x-grps": ["xtc-grps"],
+}
+
+# Write compressed .xtc frames only; full-precision .trr output is disabled
+XTC_SETTINGS = {"nstxout": 0, "nstvout": 0, "nstfout": 0, "compressed-x-precision": 1000}
+
+# Lines of a failed command's log file echoed to the terminal
+LOG_TAIL_LINES = 30
+
+TPR_CACHE_DIR = ".tpr_cache"
+INCLUDE_RE = re.compile(r'^[ \t]*#include[ \t]+"([^"]+)"', re.M)
+
+# Keys accepted in a --config file; None marks a required key
+CONFIG_DEFAULTS = {
+    "min_mdp": None,
+    "eq_mdp": None,
+    "prod_mdp": None,
+    "edit_min": False,
+    "edit_eq": False,
+    "edit_prod": False,
+    "multi_eq": False,
+    "steps": 1,
+}
 
 
 BANNER = r"""
@@ -21,34 +64,33 @@ BANNER = r"""
 # ---------------- MDP PARSER ---------------- #
 
 def read_mdp(filepath):
-    params = {}
+    # One pass: raw lines for writing back, key -> line index for lookups
     lines = []
+    key_to_index = {}
 
     with open(filepath, "r") as f:
-        for line in f:
-            stripped = line.strip()
-
-            if "=" in line and not stripped.startswith(";"):
-                key = line.split("=")[0].strip()
-                params[key] = line
+        for i, line in enumerate(f):
             lines.append(line)
+            stripped = line.lstrip()
+            if stripped and stripped[0] != ";" and "=" in stripped:
+                key_to_index[stripped.split("=", 1)[0].rstrip()] = i
 
-    return params, lines
+    return lines, key_to_index
 
 
 def write_mdp(filepath, lines):
-    with open(filepath, "w") as f:
+    # Write to a temp file and rename so a crash never leaves a truncated mdp
+    tmp = filepath + ".tmp"
+    with open(tmp, "w", buffering=1 << 20) as f:
         f.writelines(lines)
+    os.replace(tmp, filepath)
 
 
-def edit_mdp(filepath):
-    params, lines = read_mdp(filepath)
-
-    print(f"\nEditing {filepath}")
+def edit_lines(lines, key_to_index):
     print("Available parameters (current values shown):")
 
-    for k, line in params.items():
-        current_val = line.split("=", 1)[1].strip()
+    for k, i in key_to_index.items():
+        current_val = lines[i].split("=", 1)[1].strip()
         print(f" - {k:<25} = {current_val}")
 
     while True:
@@ -56,17 +98,23 @@ def edit_mdp(filepath):
         if key.lower() == "no":
             break
 
-        if key not in params:
+        if key not in key_to_index:
             print("Parameter not found.")
             continue
 
         new_val = input("New value: ").strip()
         new_line = f"{key:<25} = {new_val}\n"
 
-        for i, line in enumerate(lines):
-            if line.strip().startswith(key):
-                lines[i] = new_line
-                break
+        lines[key_to_index[key]] = new_line
+
+    return lines
+
+
+def edit_mdp(filepath):
+    lines, key_to_index = read_mdp(filepath)
+
+    print(f"\nEditing {filepath}")
+    edit_lines(lines, key_to_index)
 
     write_mdp(filepath, lines)
     print(f"{filepath} updated.")
@@ -74,53 +122,458 @@ def edit_mdp(filepath):
 
 # ---------------- GMX RUNNER ---------------- #
 
-def run_cmd(cmd):
+def run_cmd(cmd, logfile=None, **kw):
     print("\nRunning:", " ".join(cmd))
-    result = subprocess.run(cmd)
+
+    if logfile is None:
+        subprocess.run(cmd, check=True, **kw)
+        return
+
+    print(f"Output -> {logfile}")
+    try:
+        with open(logfile, "w", buffering=1 << 20) as f:
+            subprocess.run(cmd, check=True, stdout=f, stderr=subprocess.STDOUT, **kw)
+    except subprocess.CalledProcessError:
+        # The error text only reached the log file, so surface its tail
+        with open(logfile, "r", errors="replace") as f:
+            tail = f.readlines()[-LOG_TAIL_LINES:]
+        print(f"\nLast {len(tail)} line(s) of {logfile}:")
+        print("".join(tail).rstrip())
+        print(f"\nFull output: {logfile}")
+        raise
+
+
+# ---------------- TPR CACHE ---------------- #
+
+def topology_files(top):
+    # topol.top plus every #include reachable from it that exists locally;
+    # force fields shipped with GROMACS are not followed.
+    files = []
+    pending = [top]
+
+    while pending:
+        path = os.path.normpath(pending.pop())
+        if path in files or not os.path.isfile(path):
+            continue
+        files.append(path)
+
+        with open(path, "r") as f:
+            includes = INCLUDE_RE.findall(f.read())
+        base = os.path.dirname(path)
+        pending.extend(os.path.join(base, inc) for inc in includes)
+
+    return sorted(files)
+
+
+def tpr_hash(files, args):
+    h = hashlib.blake2b(digest_size=16)
+    h.update("\0".join(args).encode())
+
+    for path in files:
+        if not os.path.isfile(path):
+            continue
+        h.update(path.encode())
+        with open(path, "rb") as f:
+            h.update(f.read())
+
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def random_velocities(mdp):
+    # gen-vel = yes with gen-seed = -1 (the default) draws new velocities on
+    # every grompp call, so the resulting .tpr must not be reused.
+    with open(mdp, "r") as f:
+        text = f.read()
+
+    gen_vel = mdp_key_re("gen-vel").search(text)
+    if gen_vel is None or gen_vel.group(1).strip().lower() != "yes":
+        return False
+
+    gen_seed = mdp_key_re("gen-seed").search(text)
+    return gen_seed is None or gen_seed.group(1).strip() == "-1"
+
+
+def run_grompp(mdp, tpr, gro, ref=None):
+    args = ["-f", mdp, "-c", gro]
+    if ref is not None:
+        args += ["-r", ref]
+    args += ["-p", "topol.top", "-n", "index.ndx", "-maxwarn", "1"]
+
+    if random_velocities(mdp):
+        print(f"\n{mdp} generates velocities with a random seed; not caching {tpr}")
+        cached = None
+    else:
+        inputs = [mdp, gro] + ([ref] if ref is not None else [])
+        inputs += topology_files("topol.top") + ["index.ndx"]
+        # A different grompp may write a different .tpr from the same inputs
+        key = tpr_hash(inputs, [f"gmx {gmx_version_string()}"] + args)
+        cached = os.path.join(TPR_CACHE_DIR, f"{key}.tpr")
+
+    if cached is not None and os.path.isfile(cached):
+        print(f"\nInputs unchanged, reusing {cached} for {tpr}")
+        link_or_copy(cached, tpr)
+        return
+
+    # Never let grompp write through a hard link into the cache
+    if os.path.lexists(tpr):
+        os.remove(tpr)
+
+    run_cmd(["gmx", "grompp"] + args[:2] + ["-o", tpr] + args[2:])
+
+    if cached is None:
+        return
+
+    os.makedirs(TPR_CACHE_DIR, exist_ok=True)
+    link_or_copy(tpr, cached)
+
+
+# ---------------- HARDWARE DETECTION ---------------- #
+
+def detect_cpu_cores():
+    # Cores this process may run on (respects taskset / SLURM cpusets)
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def detect_gpus():
+    # Device ids usable as CUDA_VISIBLE_DEVICES entries
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [d.strip() for d in visible.split(",") if d.strip()]
+
+    try:
+        result = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True)
+    except FileNotFoundError:
+        return []
     if result.returncode != 0:
-        print("Command failed. Exiting.")
-        exit(1)
+        return []
+
+    count = sum(1 for line in result.stdout.splitlines() if line.startswith("GPU "))
+    return [str(i) for i in range(count)]
+
+
+def detect_gpu_caps():
+    # Returns (vendor, compute capability); the lowest capability wins when
+    # several GPUs are visible since every rank must support the offload.
+    return query_gpu_caps(tuple(detect_gpus()))
+
+
+@lru_cache(maxsize=None)
+def query_gpu_caps(ids):
+    # nvidia-smi ignores CUDA_VISIBLE_DEVICES, so restrict it with --id
+    result = None
+    if ids:
+        try:
+            result = subprocess.run(
+                ["nvidia-smi", f"--id={','.join(ids)}",
+                 "--query-gpu=name,compute_cap", "--format=csv,noheader"],
+                capture_output=True, text=True
+            )
+        except FileNotFoundError:
+            pass
+
+    if result is not None and result.returncode == 0:
+        caps = []
+        for line in result.stdout.splitlines():
+            try:
+                caps.append(float(line.rsplit(",", 1)[1]))
+            except (IndexError, ValueError):
+                continue
+        if caps:
+            return "NVIDIA", min(caps)
+
+    if shutil.which("rocm-smi"):
+        return "AMD", None
+
+    return None, None
+
+
+def select_offload_flags(pme=True, bonded=True, update=True):
+    vendor, cc = detect_gpu_caps()
+    flags = ["-nb", "gpu"]
+
+    if cc is None:
+        # Unknown GPU: keep the long-standing nb/pme offload, nothing newer
+        reason = f"{vendor or 'unknown'} GPU, compute capability not detected"
+        full = False
+        pme_ok = True
+    else:
+        reason = f"{vendor} GPU, compute capability {cc}"
+        full = cc >= 7.0
+        pme_ok = cc >= 6.0
+
+    if pme and pme_ok:
+        flags += ["-pme", "gpu"]
+    if bonded and full:
+        flags += ["-bonded", "gpu"]
+    if update and full:
+        flags += ["-update", "gpu"]
+
+    print(f"GPU offload: {' '.join(flags)} ({reason})")
+    if pme and not pme_ok:
+        print("PME kept on CPU: needs compute capability 6.0 or newer.")
+    if (bonded or update) and not full:
+        print("Bonded/update kept on CPU: need compute capability 7.0 or newer.")
+
+    return flags
+
+
+def configure_gmx_env():
+    # Read by GROMACS >= 2022 thread-MPI builds; older versions ignore them.
+    # Set once here so every gmx call (and replica worker) inherits them,
+    # and never override values the user exported.
+    os.environ.setdefault("GMX_ENABLE_DIRECT_GPU_COMM", "1")
+
+    vendor, cc = detect_gpu_caps()
+    if cc is not None and cc >= 7.0:
+        os.environ.setdefault("GMX_FORCE_UPDATE_DEFAULT_GPU", "1")
+
+
+@lru_cache(maxsize=None)
+def gmx_version_string():
+    # Full version (e.g. "2023.3"), or "" when it cannot be determined
+    try:
+        result = subprocess.run(["gmx", "--version"], capture_output=True, text=True)
+    except FileNotFoundError:
+        return ""
+
+    match = re.search(r"GROMACS version:\s*(\S+)", result.stdout)
+    return match.group(1) if match else ""
+
+
+def detect_gmx_version():
+    # Major release year (e.g. 2023), or None when it cannot be determined
+    match = re.match(r"\d{4}", gmx_version_string())
+    return int(match.group(0)) if match else None
+
+
+def build_mdrun_cmd(prefix, extra=(), confout=True):
+    cores = detect_cpu_cores()
+    ranks = max(len(detect_gpus()), 1)
+    threads = max(len(cores) // ranks, 1)
+
+    cmd = [
+        "gmx", "mdrun",
+        "-v",
+        "-deffnm", prefix,
+        "-ntmpi", str(ranks),
+        "-ntomp", str(threads)
+    ]
+
+    # -pinoffset/-pinstride can only describe a contiguous range of cores;
+    # for any other mask let mdrun respect the inherited affinity instead.
+    if cores == list(range(cores[0], cores[0] + len(cores))):
+        cmd += ["-pin", "on"]
+        if cores[0] != 0:
+            cmd += ["-pinoffset", str(cores[0]), "-pinstride", "1"]
+    else:
+        cmd += ["-pin", "auto"]
+
+    extra = list(extra)
+
+    # GPU update with domain decomposition needs GROMACS 2022 or newer
+    if ranks > 1 and "-update" in extra and extra[extra.index("-update") + 1] == "gpu":
+        version = detect_gmx_version()
+        if version is None or version < 2022:
+            i = extra.index("-update")
+            del extra[i:i + 2]
+            print(f"Update kept on CPU: {ranks} ranks with GPU update need GROMACS 2022 "
+                  f"or newer (found {version or 'unknown version'}).")
+
+    cmd += extra
+
+    # Multiple ranks with PME on the GPU need a dedicated PME rank
+    if ranks > 1 and "-pme" in cmd and cmd[cmd.index("-pme") + 1] == "gpu":
+        cmd += ["-npme", "1"]
+
+    if not confout:
+        cmd.append("-noconfout")
+
+    return cmd
 
 
 # ---------------- MINIMIZATION ---------------- #
 
 def run_minimization(mdp):
-    run_cmd([
-        "gmx", "grompp",
-        "-f", mdp,
-        "-o", "minimization.tpr",
-        "-c", "step3_input.gro",
-        "-r", "step3_input.gro",
-        "-p", "topol.top",
-        "-n", "index.ndx",
-        "-maxwarn", "1"
-    ])
+    run_grompp(mdp, "minimization.tpr", "step3_input.gro", ref="step3_input.gro")
 
     run_cmd(["gmx", "mdrun", "-v", "-deffnm", "minimization"])
 
 
 # ---------------- EQUILIBRATION ---------------- #
 
-def prepare_equilibration_files(base_mdp, steps):
-    base_params, base_lines = read_mdp(base_mdp)
+def rewrite_define(lines, bb, sc):
+    # The one place define lines are rewritten: every matching line is replaced
+    new = DEFINE_TMPL.format(bb=bb, sc=sc)
+    return [new if DEFINE_RE.match(line) else line for line in lines]
+
+
+def set_posres_define(text, bb, sc):
+    return "".join(rewrite_define(text.splitlines(keepends=True), bb, sc))
+
+
+def mdp_key_re(key):
+    # mdp keys treat '-' and '_' as the same character; legacy aliases match too
+    names = [
+        "[-_]".join(re.escape(part) for part in re.split("[-_]", name))
+        for name in [key] + MDP_KEY_ALIASES.get(key, [])
+    ]
+    return re.compile(rf"^[ \t]*(?:{'|'.join(names)})[ \t]*=[ \t]*([^;\n]*)", re.M)
+
+
+def set_mdp_value(text, key, value):
+    match = mdp_key_re(key).search(text)
+
+    if match is None:
+        if text and not text.endswith("\n"):
+            text += "\n"
+        return text + f"{key:<25} = {value}\n"
+
+    # Replace only the value so spacing and trailing comments survive
+    old = match.group(1)
+    new = f"{value}{old[len(old.rstrip()):]}"
+    return text[:match.start(1)] + new + text[match.end(1):]
+
+
+def mdp_int(text, key):
+    # Integer value of key, or None when absent or not an integer
+    match = mdp_key_re(key).search(text)
+    if match is None:
+        return None
+    try:
+        return int(match.group(1).strip())
+    except ValueError:
+        return None
+
+
+def force_xtc(text):
+    # Zeroing the .trr keys must not leave the step without any trajectory:
+    # take over the old nstxout interval, or the default, when xtc is off.
+    if (mdp_int(text, "nstxout-compressed") or 0) <= 0:
+        interval = mdp_int(text, "nstxout") or 0
+        if interval <= 0:
+            interval = EQ_OUTPUT_INTERVALS["nstxout-compressed"]
+        text = set_mdp_value(text, "nstxout-compressed", interval)
+
+    for key, value in XTC_SETTINGS.items():
+        text = set_mdp_value(text, key, value)
+    return text
+
+
+def apply_output_intervals(text, source):
+    for key, interval in EQ_OUTPUT_INTERVALS.items():
+        if mdp_key_re(key).search(text) is None:
+            text = set_mdp_value(text, key, interval)
+            continue
+
+        current = mdp_int(text, key)
+        if current is not None and 0 < current < interval:
+            print(f"Warning: {source} sets {key} = {current}; "
+                  f"frequent output slows equilibration (suggested {interval}).")
+
+    return text
+
+
+def copy_with_define(src, dst, bb, sc):
+    # Build the copy beside dst and rename it into place: the write stays
+    # atomic and never touches an inode hard-linked into a replica folder
+    tmp = dst + ".tmp"
+    shutil.copyfile(src, tmp)
+
+    new = DEFINE_TMPL.format(bb=bb, sc=sc).rstrip("\n").encode()
+    text = None
+
+    # Patch in place only for a single define line of unchanged length;
+    # anything else goes through rewrite_define like the other paths
+    if os.path.getsize(tmp) > 0:
+        with open(tmp, "r+b") as f, mmap.mmap(f.fileno(), 0) as m:
+            matches = list(DEFINE_RE_BYTES.finditer(m))
+            if len(matches) == 1 and matches[0].end() - matches[0].start() == len(new):
+                m[matches[0].start():matches[0].end()] = new
+            elif matches:
+                text = m[:].decode()
+
+    if text is None:
+        os.replace(tmp, dst)
+    else:
+        os.remove(tmp)
+        write_mdp(dst, [set_posres_define(text, bb, sc)])
+
 
-    for i in range(steps):
-        bb, sc = POSRES_SCHEDULE[i]
-        new_lines = []
+def equilibration_template(base_mdp):
+    with open(base_mdp, "r") as f:
+        return force_xtc(apply_output_intervals(f.read(), base_mdp))
 
-        for line in base_lines:
-            if line.strip().startswith("define"):
-                new_lines.append(
-                    f"define                  = -DPOSRES -DPOSRES_FC_BB={bb} -DPOSRES_FC_SC={sc}\n"
-                )
-            else:
-                new_lines.append(line)
 
+def prepare_single_equilibration(base_mdp):
+    # Single step keeps the user's define line as-is
+    write_mdp("step4.1.1_equilibration.mdp", [equilibration_template(base_mdp)])
+
+
+def prepare_equilibration_files(base_mdp, steps):
+    buf = equilibration_template(base_mdp)
+
+    for i, (bb, sc) in enumerate(POSRES_SCHEDULE[:steps]):
         out_name = f"step4.1.{i+1}_equilibration.mdp"
-        write_mdp(out_name, new_lines)
+        write_mdp(out_name, [set_posres_define(buf, bb, sc)])
         print(f"Created {out_name}")
 
 
+def uses_posres(mdp):
+    lines, key_to_index = read_mdp(mdp)
+    if "define" not in key_to_index:
+        return False
+    return "POSRES" in lines[key_to_index["define"]].split("=", 1)[1]
+
+
+def preflight_equilibration(steps):
+    # Opt-in (--check-mdp): adds one grompp per step before the run, in
+    # exchange for a bad step 5 failing before step 1 spends hours in mdrun.
+    if steps < 1:
+        return
+
+    print(f"\nChecking {steps} equilibration MDP file(s) with grompp...")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def check(i):
+            cmd = [
+                "gmx", "grompp",
+                "-f", f"step4.1.{i}_equilibration.mdp",
+                "-o", os.path.join(tmp, f"equilibration{i}.tpr"),
+                "-po", os.path.join(tmp, f"equilibration{i}_mdout.mdp"),
+                "-c", "step3_input.gro",
+                "-r", "step3_input.gro",
+                "-p", "topol.top",
+                "-n", "index.ndx",
+                "-maxwarn", "1"
+            ]
+            return i, subprocess.run(cmd, capture_output=True, text=True)
+
+        with ThreadPoolExecutor(max_workers=steps) as pool:
+            results = list(pool.map(check, range(1, steps + 1)))
+
+    failed = False
+    for i, result in results:
+        if result.returncode != 0:
+            print(f"\ngrompp failed for step4.1.{i}_equilibration.mdp:")
+            print(result.stderr)
+            failed = True
+
+    if failed:
+        raise SystemExit("Equilibration MDP check failed. Exiting.")
+
+
 def run_equilibration(steps):
     prev_gro = "minimization.gro"
 
@@ -129,23 +582,20 @@ def run_equilibration(steps):
         tpr = f"equilibration{i}.tpr"
         prefix = f"equilibration{i}"
 
-        run_cmd([
-            "gmx", "grompp",
-            "-f", mdp,
-            "-o", tpr,
-            "-c", prev_gro,
-            "-r", "step3_input.gro",
-            "-p", "topol.top",
-            "-n", "index.ndx",
-            "-maxwarn", "1"
-        ])
-
-        run_cmd([
-            "gmx", "mdrun",
-            "-v",
-            "-deffnm", prefix,
-            "-nb", "gpu"
-        ])
+        run_grompp(mdp, tpr, prev_gro, ref="step3_input.gro")
+
+        posres = uses_posres(mdp)
+        if posres:
+            print(f"Warning: {mdp} defines position restraints; "
+                  "running update on CPU for this step.")
+
+        offload = select_offload_flags(update=not posres)
+        if posres:
+            # Explicit, so GMX_FORCE_UPDATE_DEFAULT_GPU cannot move it back
+            offload += ["-update", "cpu"]
+
+        # mdrun writes its own {prefix}.log, keep console output separate
+        run_cmd(build_mdrun_cmd(prefix, offload), logfile=f"{prefix}_stdout.log")
 
         prev_gro = f"{prefix}.gro"
 
@@ -155,31 +605,195 @@ def run_equilibration(steps):
 # ---------------- PRODUCTION ---------------- #
 
 def run_production(mdp, input_gro):
-    run_cmd([
-        "gmx", "grompp",
-        "-f", mdp,
-        "-o", "production.tpr",
-        "-c", input_gro,
-        "-p", "topol.top",
-        "-n", "index.ndx",
-        "-maxwarn", "1"
-    ])
-
-    run_cmd([
-        "gmx", "mdrun",
-        "-v",
-        "-deffnm", "production",
-        "-nb", "gpu",
-        "-pme", "gpu"
-    ])
+    run_grompp(mdp, "production.tpr", input_gro)
+
+    run_cmd(build_mdrun_cmd(
+        "production",
+        select_offload_flags(),
+        confout=False
+    ), logfile="production_stdout.log")
+
+
+# ---------------- REPLICAS ---------------- #
+
+def run_pipeline(min_mdp, steps, prod_mdp):
+    run_minimization(min_mdp)
+    final_gro = run_equilibration(steps)
+    run_production(prod_mdp, final_gro)
+
+
+def stage_replica(workdir, mdps):
+    os.makedirs(workdir, exist_ok=True)
+
+    inputs = ["step3_input.gro", "index.ndx"] + topology_files("topol.top")
+    for path in inputs:
+        # Includes outside the run directory are not reachable from a replica
+        if os.path.isabs(path) or path.startswith(".."):
+            continue
+        dst = os.path.join(workdir, path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        link_or_copy(path, dst)
+
+    for mdp in mdps:
+        link_or_copy(mdp, os.path.join(workdir, os.path.basename(mdp)))
+
+
+def run_replica(workdir, device, cores, min_mdp, steps, prod_mdp):
+    # Pool workers can be reused, so set every piece of process state here
+    # rather than relying on what a previous task left behind.
+    os.chdir(workdir)
+    if device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    else:
+        os.environ.pop("CUDA_VISIBLE_DEVICES", None)
+    # build_mdrun_cmd sizes -ntomp and -pinoffset from this affinity mask
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    run_pipeline(min_mdp, steps, prod_mdp)
+
+
+def run_replicas(count, min_mdp, steps, prod_mdp):
+    gpus = detect_gpus()
+    cores = detect_cpu_cores()
+    per_replica = max(len(cores) // count, 1)
+
+    eq_mdps = [f"step4.1.{i}_equilibration.mdp" for i in range(1, steps + 1)]
+    mdps = [min_mdp, prod_mdp] + eq_mdps
+
+    jobs = []
+    for i in range(count):
+        workdir = os.path.abspath(f"replica_{i}")
+        stage_replica(workdir, mdps)
+
+        device = gpus[i % len(gpus)] if gpus else None
+        start = (i * per_replica) % len(cores)
+        replica_cores = cores[start:start + per_replica]
+        jobs.append((workdir, device, replica_cores))
+
+        print(f"replica_{i}: GPU {device if device is not None else 'n/a'}, "
+              f"cores {','.join(str(c) for c in replica_cores)}")
+
+    with ProcessPoolExecutor(max_workers=count) as pool:
+        futures = [
+            pool.submit(
+                run_replica, workdir, device, replica_cores,
+                os.path.basename(min_mdp), steps, os.path.basename(prod_mdp)
+            )
+            for workdir, device, replica_cores in jobs
+        ]
+        wait(futures)
+
+    failed = [(i, f.exception()) for i, f in enumerate(futures) if f.exception() is not None]
+    for i, exc in failed:
+        print(f"replica_{i} failed: {exc}")
+    if failed:
+        raise failed[0][1]
 
 
 # ---------------- MAIN WORKFLOW ---------------- #
 
-def main():
-    
-    print(BANNER)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Automated GROMACS CHARMM-GUI pipeline")
+    parser.add_argument(
+        "--config", metavar="FILE",
+        help="JSON or YAML file with the answers to the interactive prompts"
+    )
+    parser.add_argument(
+        "--check-mdp", action="store_true",
+        help="grompp every equilibration MDP up front so a broken step fails early"
+    )
+    parser.add_argument(
+        "--replicas", type=int, default=1, metavar="K",
+        help="run K independent copies of the pipeline in replica_<i>/, one GPU each"
+    )
+
+    args = parser.parse_args()
+    if args.replicas < 1:
+        parser.error("--replicas must be at least 1")
+    return args
+
+
+def load_config(path):
+    # JSONDecodeError and UnicodeDecodeError are both ValueErrors
+    parse_errors = (ValueError,)
+    is_yaml = path.endswith((".yaml", ".yml"))
+
+    if is_yaml:
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit("YAML configs need PyYAML (pip install pyyaml); "
+                             "use a .json config instead.")
+        parse_errors += (yaml.YAMLError,)
+
+    try:
+        with open(path, "r") as f:
+            config = yaml.safe_load(f) if is_yaml else json.load(f)
+    except OSError as e:
+        raise SystemExit(f"{path}: cannot read config ({e.strerror}).")
+    except parse_errors as e:
+        raise SystemExit(f"{path}: invalid {'YAML' if is_yaml else 'JSON'}: {e}")
+
+    if not isinstance(config, dict):
+        raise SystemExit(f"{path}: expected a mapping of settings.")
+
+    unknown = sorted(set(config) - set(CONFIG_DEFAULTS))
+    if unknown:
+        raise SystemExit(f"{path}: unknown setting(s): {', '.join(unknown)}")
+
+    missing = [k for k, v in CONFIG_DEFAULTS.items() if v is None and k not in config]
+    if missing:
+        raise SystemExit(f"{path}: missing required setting(s): {', '.join(missing)}")
+
+    config = {**CONFIG_DEFAULTS, **config}
+
+    for key in ("min_mdp", "eq_mdp", "prod_mdp"):
+        if not isinstance(config[key], str) or not config[key]:
+            raise SystemExit(f"{path}: {key} must be a file name.")
+
+    for key in ("edit_min", "edit_eq", "edit_prod", "multi_eq"):
+        if not isinstance(config[key], bool):
+            raise SystemExit(f"{path}: {key} must be true or false, got {config[key]!r}.")
+
+    steps = config["steps"]
+    if isinstance(steps, bool) or not isinstance(steps, int) or steps < 1:
+        raise SystemExit(f"{path}: steps must be a positive integer, got {steps!r}.")
+
+    return config
+
+
+def config_setup(config):
+    # Editing is interactive, so it is only honoured when a terminal is attached
+    for key in ("edit_min", "edit_eq", "edit_prod"):
+        if config[key] and not sys.stdin.isatty():
+            raise SystemExit(f"{key} needs an interactive terminal; "
+                             "edit the MDP file directly instead.")
+
+    min_mdp = config["min_mdp"]
+    prod_mdp = config["prod_mdp"]
+
+    if config["edit_min"]:
+        edit_mdp(min_mdp)
+
+    if config["multi_eq"]:
+        steps = min(config["steps"], MAX_EQ_STEPS)
+        prepare_equilibration_files(config["eq_mdp"], steps)
+    else:
+        steps = 1
+        prepare_single_equilibration(config["eq_mdp"])
+
+    if config["edit_eq"]:
+        for i in range(1, steps + 1):
+            edit_mdp(f"step4.1.{i}_equilibration.mdp")
+
+    if config["edit_prod"]:
+        edit_mdp(prod_mdp)
 
+    return min_mdp, steps, prod_mdp
+
+
+def interactive_setup():
     min_mdp = input("Minimization MDP filename: ").strip()
     eq_mdp = input("Equilibration MDP filename: ").strip()
     prod_mdp = input("Production MDP filename: ").strip()
@@ -202,80 +816,74 @@ def main():
         same_for_all = input("Use same parameters for remaining equilibration steps? (y/n): ").lower()
 
         if same_for_all == "y":
-            base_params, base_lines = read_mdp("step4.1.1_equilibration.mdp")
-
             for i in range(2, steps + 1):
                 bb, sc = POSRES_SCHEDULE[i-1]
-                new_lines = []
-
-                for line in base_lines:
-                    if line.strip().startswith("define"):
-                        new_lines.append(
-                            f"define                  = -DPOSRES -DPOSRES_FC_BB={bb} -DPOSRES_FC_SC={sc}\n"
-                        )
-                    else:
-                        new_lines.append(line)
-
-                write_mdp(f"step4.1.{i}_equilibration.mdp", new_lines)
+                copy_with_define("step4.1.1_equilibration.mdp", f"step4.1.{i}_equilibration.mdp", bb, sc)
                 print(f"Updated step4.1.{i}_equilibration.mdp with same settings.")
         else:
-            prev_template = "step4.1.1_equilibration.mdp"
+            # Edits carry over from step to step, so keep one parsed copy in memory
+            lines, key_to_index = read_mdp("step4.1.1_equilibration.mdp")
 
             for i in range(2, steps + 1):
                 bb, sc = POSRES_SCHEDULE[i-1]
 
                 print(f"\nEditing equilibration step {i}")
-                edit_mdp(prev_template)
+                edit_lines(lines, key_to_index)
 
-                params, lines = read_mdp(prev_template)
-                new_lines = []
-
-                for line in lines:
-                    if line.strip().startswith("define"):
-                        new_lines.append(
-                            f"define                  = -DPOSRES -DPOSRES_FC_BB={bb} -DPOSRES_FC_SC={sc}\n"
-                        )
-                    else:
-                        new_lines.append(line)
+                lines = rewrite_define(lines, bb, sc)
 
                 current_file = f"step4.1.{i}_equilibration.mdp"
-                write_mdp(current_file, new_lines)
+                write_mdp(current_file, lines)
 
                 same_as_this = input(f"Use these settings for remaining steps after {i}? (y/n): ").lower()
                 if same_as_this == "y":
                     for j in range(i + 1, steps + 1):
                         bb2, sc2 = POSRES_SCHEDULE[j-1]
-                        copied_lines = []
-
-                        for line in new_lines:
-                            if line.strip().startswith("define"):
-                                copied_lines.append(
-                                    f"define                  = -DPOSRES -DPOSRES_FC_BB={bb2} -DPOSRES_FC_SC={sc2}\n"
-                                )
-                            else:
-                                copied_lines.append(line)
-
-                        write_mdp(f"step4.1.{j}_equilibration.mdp", copied_lines)
+                        write_mdp(f"step4.1.{j}_equilibration.mdp", rewrite_define(lines, bb2, sc2))
                         print(f"Updated step4.1.{j}_equilibration.mdp")
 
                     break
 
-                prev_template = current_file
-
     else:
         steps = 1
-        shutil.copy(eq_mdp, "step4.1.1_equilibration.mdp")
+        prepare_single_equilibration(eq_mdp)
         if input("Edit equilibration MDP? (y/n): ").lower() == "y":
             edit_mdp("step4.1.1_equilibration.mdp")
 
     if input("Edit production MDP? (y/n): ").lower() == "y":
         edit_mdp(prod_mdp)
 
+    return min_mdp, steps, prod_mdp
+
+
+def main():
+    args = parse_args()
+
+    if args.config:
+        min_mdp, steps, prod_mdp = config_setup(load_config(args.config))
+    else:
+        # Answers may also be piped in (script.py < answers.txt)
+        if sys.stdin.isatty():
+            print(BANNER)
+        try:
+            min_mdp, steps, prod_mdp = interactive_setup()
+        except EOFError:
+            raise SystemExit("\nInput ended before all prompts were answered; "
+                             "use --config FILE for batch runs.")
+
     print("\n--- STARTING SIMULATION PIPELINE ---")
 
-    run_minimization(min_mdp)
-    final_gro = run_equilibration(steps)
-    run_production(prod_mdp, final_gro)
+    configure_gmx_env()
+
+    try:
+        if args.check_mdp:
+            preflight_equilibration(steps)
+        if args.replicas > 1:
+            run_replicas(args.replicas, min_mdp, steps, prod_mdp)
+        else:
+            run_pipeline(min_mdp, steps, prod_mdp)
+    except subprocess.CalledProcessError as e:
+        raise SystemExit(f"{' '.join(e.cmd[:2])} failed with code {e.returncode}")
 
     print("\nALL SIMULATIONS COMPLETED SUCCESSFULLY.")
 